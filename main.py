@@ -1,18 +1,54 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException
-from fastapi.responses import HTMLResponse, JSONResponse, FileResponse
+from fastapi import FastAPI, UploadFile, File, HTTPException, Request, BackgroundTasks
+from fastapi.responses import HTMLResponse, FileResponse, Response, ORJSONResponse
 from fastapi.staticfiles import StaticFiles
+from fastapi.concurrency import run_in_threadpool
 from ultralytics import YOLO  # Используем YOLO из ultralytics
+from ultralytics.utils.plotting import colors as yolo_colors
+from ultralytics.engine.results import Results
 import cv2
 import os
+import sys
+import io
+import gzip
+import hashlib
 import uuid
 import time
+import asyncio
+import atexit
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
 import json
 import numpy as np
+import torch
+from PIL import Image, ImageOps, UnidentifiedImageError
 from pathlib import Path
+from functools import lru_cache
 import shutil
 
+# Логирование через очередь: запись в поток вывода идет в фоновом потоке QueueListener,
+# а не в обработчике запроса
+logger = logging.getLogger(__name__)
+
+def setup_logging():
+    """Подключает к логгеру приложения QueueHandler с фоновым QueueListener"""
+    log_queue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    
+    listener = QueueListener(log_queue, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)
+    
+    logger.addHandler(QueueHandler(log_queue))
+    logger.setLevel(os.getenv("FLARE_LOG_LEVEL", "INFO").upper())
+    logger.propagate = False
+
+setup_logging()
+
 app = FastAPI(title="Анализатор факелов газа", 
-              description="Обнаружение газовых факелов с помощью локальной модели YOLO")
+              description="Обнаружение газовых факелов с помощью локальной модели YOLO",
+              default_response_class=ORJSONResponse)
 
 # Пути к модели и файлам
 BASE_DIR = Path("E:/Python/MIFI/project-practice")
@@ -20,25 +56,318 @@ MODEL_PATH = BASE_DIR / "models/trained/best_model.pt"
 UPLOAD_DIR = BASE_DIR / "static/uploads"
 RESULT_DIR = BASE_DIR / "static/results"
 
+# Сохранять ли оригиналы загрузок на диск (нужно только для отладки)
+SAVE_UPLOADS = os.getenv("FLARE_SAVE_UPLOADS", "0") == "1"
+UPLOAD_COPY_CHUNK = 1024 * 1024  # Буфер копирования 1 МБ вместо стандартного
+
+# Ограничение размера загрузки и размер блока чтения
+MAX_UPLOAD_BYTES = 20 * 1024 * 1024
+UPLOAD_READ_CHUNK = 1024 * 1024
+# Ограничение по пикселям: сжатый файл в 20 МБ может развернуться в кадр на сотни МБ
+MAX_IMAGE_PIXELS = 50_000_000
+
+# Результаты всегда сохраняем в JPEG: кодирование быстрее PNG, файлы меньше
+RESULT_JPEG_QUALITY = 85
+
+# libjpeg-turbo через PyTurboJPEG (SIMD), если библиотека установлена; иначе cv2.imencode
+try:
+    from turbojpeg import TurboJPEG
+    turbo_jpeg = TurboJPEG()
+except (ImportError, RuntimeError, OSError):
+    turbo_jpeg = None
+
 # Создаем директории
 for directory in [UPLOAD_DIR, RESULT_DIR]:
     directory.mkdir(parents=True, exist_ok=True)
 
-# Монтируем статические файлы
+class ImmutableStaticFiles(StaticFiles):
+    """Статика с долгим кэшированием: имена результатов уникальны (UUID) и не меняются"""
+    
+    def file_response(self, *args, **kwargs):
+        response = super().file_response(*args, **kwargs)
+        response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        return response
+
+# Монтируем статические файлы (результаты — раньше общего /static, чтобы маршрут сработал первым)
+app.mount("/static/results", ImmutableStaticFiles(directory=RESULT_DIR), name="results")
 app.mount("/static", StaticFiles(directory=BASE_DIR / "static"), name="static")
 
+# Параметры инференса
+IMGSZ = 640  # Размер входа модели (engine собирается под фиксированный размер)
+DEVICE = 0 if torch.cuda.is_available() else 'cpu'
+
+# Динамический батчинг запросов (на CPU батч не дает выигрыша)
+BATCH_SIZE = 8 if DEVICE != 'cpu' else 1
+# Сколько ждем остальные запросы батча, секунды
+BATCH_MAX_WAIT = float(os.getenv("FLARE_BATCH_MAX_WAIT_MS", "5")) / 1000
+WARMUP_RUNS = 3
+
+# cuDNN один раз подбирает самые быстрые алгоритмы свертки под размер входа
+torch.backends.cudnn.benchmark = True
+
+# TF32 на тензорных ядрах Ampere+ для случая, когда работает .pt модель (без TensorRT)
+torch.set_float32_matmul_precision('high')
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+
+# Экспортированные модели кэшируются рядом с весами .pt
+ENGINE_PATH = MODEL_PATH.with_suffix(".engine")
+OPENVINO_PATH = MODEL_PATH.with_name(f"{MODEL_PATH.stem}_openvino_model")
+
+# INT8-квантизация (включается флагом: на некоторых GPU INT8 дает регрессию точности)
+USE_INT8 = os.getenv("FLARE_USE_INT8", "0") == "1"
+CALIB_DIR = BASE_DIR / "flaring-gas/valid"  # Неразмеченные изображения для калибровки
+CALIB_YAML = BASE_DIR / "calibration.yaml"
+VALID_DATA_DIR = BASE_DIR / "data/processed"  # Размеченный датасет для проверки mAP
+VALID_IMAGES = "images/valid"
+VALID_LABELS_DIR = VALID_DATA_DIR / "labels/valid"
+VALID_YAML = BASE_DIR / "validation.yaml"
+INT8_ENGINE_PATH = MODEL_PATH.with_name(f"{MODEL_PATH.stem}_int8.engine")
+# Веса для экспорта кандидата: engine получает имя *_int8_candidate.engine
+# и переименовывается в INT8_ENGINE_PATH только после проверки mAP
+INT8_WEIGHTS_PATH = MODEL_PATH.with_name(f"{MODEL_PATH.stem}_int8_candidate.pt")
+INT8_REJECTED_PATH = INT8_ENGINE_PATH.with_suffix(".rejected")  # Отметка о забракованном INT8
+INT8_MAX_MAP_DROP = 0.02  # Допустимое падение mAP50-95 относительно FP16
+
+def is_export_fresh(export_path: Path) -> bool:
+    """Проверяет, что экспортированная модель существует и не старее весов .pt.
+    
+    Если весов .pt нет (на сервер выложен только готовый engine), используем то, что есть.
+    """
+    if not export_path.exists():
+        return False
+    if not MODEL_PATH.exists():
+        return True
+    return export_path.stat().st_mtime >= MODEL_PATH.stat().st_mtime
+
+def engine_batch_size(engine_path: Path) -> int:
+    """Статический размер батча TensorRT engine (0 — engine с динамическим батчем).
+    
+    Ultralytics пишет перед engine заголовок: 4 байта длины и JSON с параметрами экспорта.
+    Engine без такого заголовка считаем собранным с батчем по умолчанию (1).
+    """
+    try:
+        with open(engine_path, "rb") as f:
+            meta_len = int.from_bytes(f.read(4), byteorder="little")
+            metadata = json.loads(f.read(meta_len).decode("utf-8")) if meta_len < 1 << 20 else {}
+    except (OSError, ValueError):
+        metadata = {}
+    if not isinstance(metadata, dict):
+        metadata = {}
+    if metadata.get("dynamic"):
+        return 0
+    return int(metadata.get("batch") or 1)
+
+def export_engine():
+    """Экспорт модели в TensorRT FP16 engine (один раз, далее берется из кэша)"""
+    if is_export_fresh(ENGINE_PATH):
+        cached_batch = engine_batch_size(ENGINE_PATH)
+        # Engine со старым размером батча пересобираем, если есть из чего
+        if cached_batch == BATCH_SIZE or not MODEL_PATH.exists():
+            logger.info("♻️ Используем готовый TensorRT engine: %s", ENGINE_PATH)
+            return ENGINE_PATH
+        logger.info("♻️ TensorRT engine собран с батчем %s, нужен %s", cached_batch, BATCH_SIZE)
+    
+    logger.info("⚙️ Экспортирую модель в TensorRT FP16 engine...")
+    exported = YOLO(str(MODEL_PATH)).export(
+        format="engine",
+        half=True,
+        imgsz=IMGSZ,
+        dynamic=False,
+        batch=BATCH_SIZE,
+        workspace=4,
+        device=DEVICE
+    )
+    return Path(exported)
+
+def export_openvino():
+    """Экспорт модели в OpenVINO IR для инференса на x86 CPU"""
+    if is_export_fresh(OPENVINO_PATH):
+        logger.info("♻️ Используем готовую OpenVINO модель: %s", OPENVINO_PATH)
+        return OPENVINO_PATH
+    
+    logger.info("⚙️ Экспортирую модель в OpenVINO FP16...")
+    exported = YOLO(str(MODEL_PATH)).export(
+        format="openvino",
+        half=True,
+        imgsz=IMGSZ,
+        dynamic=False,
+        batch=BATCH_SIZE
+    )
+    return Path(exported)
+
+def write_dataset_yaml(yaml_path: Path, data_dir: Path, images: str, names: dict):
+    """Создает описание датасета для калибровки INT8 или проверки mAP"""
+    import yaml
+    
+    dataset = {
+        "path": str(data_dir),
+        "train": images,
+        "val": images,
+        "names": dict(names)
+    }
+    with open(yaml_path, "w", encoding="utf-8") as f:
+        yaml.safe_dump(dataset, f, allow_unicode=True)
+
+def has_valid_labels() -> bool:
+    """Проверяет, что у валидационной выборки есть разметка"""
+    return VALID_LABELS_DIR.is_dir() and any(VALID_LABELS_DIR.glob("*.txt"))
+
+def validate_map(model_path: Path) -> float:
+    """mAP50-95 модели на размеченной валидационной выборке"""
+    metrics = YOLO(str(model_path), task="detect").val(
+        data=str(VALID_YAML),
+        imgsz=IMGSZ,
+        batch=BATCH_SIZE,
+        device=DEVICE,
+        verbose=False,
+        plots=False
+    )
+    return float(metrics.box.map)
+
+def weights_mtime() -> str:
+    """Версия весов .pt, к которой привязана отметка о забракованном INT8"""
+    return str(MODEL_PATH.stat().st_mtime) if MODEL_PATH.exists() else ""
+
+def is_int8_rejected() -> bool:
+    """Проверяет, что INT8 для текущих весов уже был забракован"""
+    if not INT8_REJECTED_PATH.exists():
+        return False
+    return INT8_REJECTED_PATH.read_text(encoding="utf-8").strip() == weights_mtime()
+
+def reject_int8(exported: Path):
+    """Удаляет INT8 engine и запоминает отказ, чтобы не повторять калибровку при рестартах"""
+    exported.unlink(missing_ok=True)
+    INT8_REJECTED_PATH.write_text(weights_mtime(), encoding="utf-8")
+
+def export_int8_engine(fp16_engine: Path):
+    """Экспорт в TensorRT INT8 engine с калибровкой.
+    
+    Возвращает None, если INT8 теряет больше INT8_MAX_MAP_DROP mAP по сравнению с FP16
+    или точность проверить не на чем.
+    """
+    if is_export_fresh(INT8_ENGINE_PATH):
+        logger.info("♻️ Используем готовый TensorRT INT8 engine: %s", INT8_ENGINE_PATH)
+        return INT8_ENGINE_PATH
+    
+    if is_int8_rejected():
+        logger.info("♻️ INT8 engine уже забракован для текущих весов, остаемся на FP16")
+        return None
+    
+    if not CALIB_DIR.exists():
+        logger.warning("⚠️ Нет калибровочных изображений: %s", CALIB_DIR)
+        return None
+    
+    # Без разметки mAP не посчитать, а непроверенный INT8 не используем
+    if not has_valid_labels():
+        logger.warning("⚠️ Нет разметки для проверки INT8: %s", VALID_LABELS_DIR)
+        return None
+    
+    # Ultralytics кладет engine рядом с весами, поэтому INT8 собираем из копии весов,
+    # чтобы не перезаписать FP16 engine. Непроверенный кандидат под именем
+    # INT8_ENGINE_PATH не появляется: упавшая или прерванная проверка не даст его загрузить
+    shutil.copy2(MODEL_PATH, INT8_WEIGHTS_PATH)
+    int8_model = YOLO(str(INT8_WEIGHTS_PATH))
+    write_dataset_yaml(CALIB_YAML, CALIB_DIR, ".", int8_model.names)
+    write_dataset_yaml(VALID_YAML, VALID_DATA_DIR, VALID_IMAGES, int8_model.names)
+    
+    logger.info("⚙️ Экспортирую модель в TensorRT INT8 engine (калибровка)...")
+    exported = Path(int8_model.export(
+        format="engine",
+        int8=True,
+        data=str(CALIB_YAML),
+        imgsz=IMGSZ,
+        workspace=6,
+        batch=BATCH_SIZE,
+        device=DEVICE
+    ))
+    
+    # Проверяем, что квантизация не испортила точность
+    try:
+        fp16_map = validate_map(fp16_engine)
+        int8_map = validate_map(exported)
+    except Exception:
+        exported.unlink(missing_ok=True)
+        raise
+    logger.info("📐 mAP50-95: FP16 = %.4f, INT8 = %.4f", fp16_map, int8_map)
+    
+    # Нулевой mAP у FP16 означает, что проверка не сработала (пустая или чужая разметка).
+    # Это проблема данных, а не INT8, поэтому отказ не запоминаем
+    if fp16_map <= 0:
+        logger.warning("⚠️ Не удалось проверить точность INT8, остаемся на FP16")
+        exported.unlink(missing_ok=True)
+        return None
+    
+    if fp16_map - int8_map > INT8_MAX_MAP_DROP:
+        logger.warning("⚠️ INT8 engine теряет точность, остаемся на FP16")
+        reject_int8(exported)
+        return None
+    
+    return exported.replace(INT8_ENGINE_PATH)
+
+def load_model(model_source: Path):
+    """Загружает модель и сразу проверяет ее пробным проходом.
+    
+    Экспорт YOLO загружает лениво: engine десериализуется только при первом обращении,
+    поэтому несовместимый engine (с другого GPU или от другой версии TensorRT)
+    проявится здесь, а не на запросах.
+    Возвращает модель и статический размер батча engine (0 — батч не фиксирован).
+    """
+    # Engine со статическим батчем принимает ровно столько изображений, сколько задано
+    # при сборке (берем из его заголовка): неполные батчи придется дополнять
+    engine_batch = engine_batch_size(model_source) if Path(model_source).suffix == ".engine" else 0
+    
+    loaded = YOLO(str(model_source), task="detect")
+    blank = np.zeros((IMGSZ, IMGSZ, 3), dtype=np.uint8)
+    loaded.predict(
+        source=[blank] * (engine_batch or 1),
+        imgsz=IMGSZ,
+        half=DEVICE != 'cpu',
+        device=DEVICE,
+        verbose=False,
+        save=False
+    )
+    return loaded, engine_batch
+
 # Загружаем модель (при старте приложения)
-print("🚀 Загружаю модель YOLO...")
+logger.info("🚀 Загружаю модель YOLO...")
 try:
-    model = YOLO(str(MODEL_PATH))
-    print(f"✅ Модель загружена: {MODEL_PATH}")
+    model_source = MODEL_PATH
+    try:
+        if DEVICE != 'cpu':
+            model_source = export_engine()
+            if USE_INT8:
+                model_source = export_int8_engine(model_source) or model_source
+        else:
+            # OpenVINO сам выбирает устройство и точность (bf16 на CPU с AMX)
+            model_source = export_openvino()
+    except Exception as e:
+        logger.warning("⚠️ Не удалось экспортировать модель, используем PyTorch: %s", e)
+    
+    try:
+        model, engine_batch = load_model(model_source)
+    except Exception as e:
+        if Path(model_source) == MODEL_PATH:
+            raise
+        logger.warning("⚠️ Экспортированная модель не запускается, используем PyTorch: %s", e)
+        model_source = MODEL_PATH
+        model, engine_batch = load_model(model_source)
+    logger.info("✅ Модель загружена: %s", model_source)
+    
+    static_batch = engine_batch > 0
+    model_batch_size = engine_batch or BATCH_SIZE
     
     # Проверяем классы модели
     if hasattr(model, 'names'):
-        print(f"📊 Классы модели: {model.names}")
+        logger.info("📊 Классы модели: %s", model.names)
 except Exception as e:
-    print(f"❌ Ошибка загрузки модели: {e}")
+    logger.error("❌ Ошибка загрузки модели: %s", e)
     model = None
+    static_batch = False
+    model_batch_size = BATCH_SIZE
+
+# Список классов модели не меняется, строим его один раз
+MODEL_CLASSES = list(model.names.values()) if model is not None and hasattr(model, 'names') else []
 
 # Цвета для разных классов
 COLORS = {
@@ -50,59 +379,255 @@ COLORS = {
     2: (128, 128, 128),        # Серый для класса 2
 }
 
-def process_with_yolo(image_path: str, confidence_threshold: float = 0.25):
-    """Обработка изображения с помощью локальной модели YOLO"""
+# Таблица цветов по class_id: считается один раз, в цикле отрисовки — только индексация.
+# Кортежи из int, а не массив np.uint8: cv2 принимает их без преобразования на каждый бокс
+CLASS_COLORS = tuple(
+    tuple(int(c) for c in COLORS.get(model.names[class_id], COLORS.get(class_id, (255, 255, 255))))
+    for class_id in sorted(model.names)
+) if model is not None else ()
+
+# Параметры подписей
+LABEL_FONT = cv2.FONT_HERSHEY_SIMPLEX
+LABEL_FONT_SCALE = 0.6
+LABEL_THICKNESS = 2
+
+@lru_cache(maxsize=1024)
+def label_size(label: str):
+    """Размер подписи в пикселях (подписей немного: класс + процент уверенности)"""
+    return cv2.getTextSize(label, LABEL_FONT, LABEL_FONT_SCALE, LABEL_THICKNESS)
+
+# Отрисовка штатным Annotator Ultralytics (results.plot) — один вызов на все боксы.
+# FLARE_ANNOTATE_WITH_YOLO=0 — собственная отрисовка draw_predictions (подписи с уверенностью в процентах)
+ANNOTATE_WITH_YOLO = os.getenv("FLARE_ANNOTATE_WITH_YOLO", "1") == "1"
+
+# Те же цвета классов используем в палитре Ultralytics (палитра хранит RGB)
+for class_id, color in enumerate(CLASS_COLORS[:len(yolo_colors.palette)]):
+    yolo_colors.palette[class_id] = color[::-1]
+
+def decode_image(fp):
+    """Декодирует изображение через Pillow(-SIMD) в BGR ndarray для OpenCV и YOLO.
     
-    if model is None:
-        raise ValueError("Модель не загружена")
+    Как и cv2.imread, возвращает None, если файл не удалось прочитать.
+    Массив только для чтения: он смотрит прямо в буфер, который отдал Pillow.
+    """
+    try:
+        with Image.open(fp) as img:
+            # Размер известен из заголовка, проверяем его до декодирования пикселей
+            if img.width * img.height > MAX_IMAGE_PIXELS:
+                return None
+            
+            # cv2.imread учитывает EXIF-ориентацию, сохраняем это поведение
+            # (in_place: без поворота Pillow иначе возвращает полную копию кадра)
+            ImageOps.exif_transpose(img, in_place=True)
+            rgb = img if img.mode == "RGB" else img.convert("RGB")
+            # Pillow сразу упаковывает пиксели в порядке BGR: без cvtColor и лишних копий кадра
+            data = rgb.tobytes("raw", "BGR")
+            return np.frombuffer(data, dtype=np.uint8).reshape(rgb.height, rgb.width, 3)
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError):
+        return None
+
+def save_upload(path: Path, data):
+    """Сохраняет оригинал загрузки на диск"""
+    path.write_bytes(data)
+    logger.debug("📥 Файл сохранен: %s", path)
+
+def copy_upload(src_path: Path, dst_path: Path):
+    """Копирует файл в uploads крупными блоками"""
+    with open(src_path, "rb") as src, open(dst_path, "wb") as dst:
+        shutil.copyfileobj(src, dst, length=UPLOAD_COPY_CHUNK)
+
+def link_upload(src_path: Path, dst_path: Path):
+    """Создает в uploads ссылку на файл; если ссылки недоступны (Windows без прав) — копирует"""
+    try:
+        dst_path.symlink_to(src_path)
+    except OSError:
+        copy_upload(src_path, dst_path)
+
+def extract_detections(result):
+    """Переводит результат YOLO в список детекций"""
+    
+    boxes = result.boxes
+    
+    if boxes is None or len(boxes) == 0:
+        return []
+    
+    # Одна копия GPU -> CPU на каждый тензор вместо трех копий на каждый bounding box
+    xyxy = boxes.xyxy.cpu().numpy()
+    confidences = boxes.conf.cpu().numpy()
+    class_ids = boxes.cls.cpu().numpy().astype(int)
+    names = model.names
+    
+    # tolist() уже дает числа Python, дополнительные float()/int() не нужны
+    return [
+        {
+            'class': names.get(class_id, f"class_{class_id}"),
+            'class_id': class_id,
+            'confidence': confidence,
+            'x': (x1 + x2) * 0.5,
+            'y': (y1 + y2) * 0.5,
+            'width': x2 - x1,
+            'height': y2 - y1,
+            'x1': x1,
+            'y1': y1,
+            'x2': x2,
+            'y2': y2
+        }
+        for (x1, y1, x2, y2), confidence, class_id in zip(xyxy.tolist(), confidences.tolist(), class_ids.tolist())
+    ]
+
+def get_class_stats(class_ids: np.ndarray) -> dict:
+    """Количество детекций по классам (подсчет через np.bincount, без цикла Python)"""
+    
+    if len(class_ids) == 0:
+        return {}
+    
+    counts = np.bincount(class_ids)
+    return {
+        model.names.get(class_id, f"class_{class_id}"): int(count)
+        for class_id, count in enumerate(counts)
+        if count
+    }
+
+def predict_batch(images: list, confidence_threshold: float):
+    """Один проход YOLO по батчу изображений (BGR ndarray)"""
+    
+    batch = list(images)
+    if static_batch:
+        # Статический engine принимает ровно model_batch_size изображений
+        blank = np.zeros((IMGSZ, IMGSZ, 3), dtype=np.uint8)
+        batch += [blank] * (model_batch_size - len(batch))
     
-    # Выполняем предсказание
     results = model.predict(
-        source=image_path,
+        source=batch,
         conf=confidence_threshold,
         iou=0.45,
-        device='cpu',  # Можно изменить на 'cuda' если есть GPU
+        imgsz=IMGSZ,
+        rect=False,  # Всегда квадратный letterbox IMGSZ x IMGSZ: кэш ядер cuDNN/TensorRT не сбрасывается
+        half=DEVICE != 'cpu',  # FP16 на тензорных ядрах GPU (на CPU не поддерживается)
+        device=DEVICE,
         verbose=False,
         save=False
     )
+    return results[:len(images)]
+
+@torch.inference_mode()
+def detect_batch(images: list, confidence_thresholds: list):
+    """Предсказание по батчу и отбор боксов по порогу каждого запроса.
+    
+    Детекции здесь не разбираются: это делает finish_result в потоке самого запроса,
+    чтобы не занимать единственный воркер батчей.
+    """
     
-    # Извлекаем результаты
-    detections = []
+    # В батче предсказание идет с минимальным порогом среди запросов
+    results = predict_batch(images, min(confidence_thresholds))
+    return [
+        result[result.boxes.conf >= conf]
+        for result, conf in zip(results, confidence_thresholds)
+    ]
+
+@torch.inference_mode()
+def rescale_result(result, image: np.ndarray):
+    """Переносит результат с уменьшенной копии на исходное изображение"""
+    boxes = result.boxes.data.clone()
+    model_height, model_width = result.orig_shape
+    height, width = image.shape[:2]
+    boxes[:, [0, 2]] *= width / model_width
+    boxes[:, [1, 3]] *= height / model_height
     
-    if results and len(results) > 0:
-        boxes = results[0].boxes
+    return Results(image, path=result.path, names=result.names, boxes=boxes)
+
+@torch.inference_mode()
+def finish_result(result, image: np.ndarray):
+    """Разбор результата одного запроса: детекции в координатах исходного изображения"""
+    if result.orig_shape != image.shape[:2]:
+        result = rescale_result(result, image)
+    return extract_detections(result), result
+
+class InferenceBatcher:
+    """Собирает одновременные запросы в батч и выполняет их одним вызовом model.predict"""
+    
+    def __init__(self, batch_size: int, max_wait: float):
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.queue = None
+        self.worker = None
+    
+    async def submit(self, image: np.ndarray, confidence_threshold: float):
+        """Ставит изображение в очередь и ждет его результат (Results)"""
+        # Очередь и воркер создаем в работающем event loop при первом запросе
+        if self.worker is None:
+            self.queue = asyncio.Queue()
+            self.worker = asyncio.create_task(self._run())
         
-        if boxes is not None and len(boxes) > 0:
-            for box in boxes:
-                # Координаты bounding box
-                x1, y1, x2, y2 = box.xyxy[0].cpu().numpy()
-                confidence = float(box.conf[0].cpu().numpy())
-                class_id = int(box.cls[0].cpu().numpy())
-                
-                # Получаем имя класса
-                class_name = model.names.get(class_id, f"class_{class_id}")
-                
-                # Центр bounding box
-                center_x = (x1 + x2) / 2
-                center_y = (y1 + y2) / 2
-                width = x2 - x1
-                height = y2 - y1
-                
-                detections.append({
-                    'class': class_name,
-                    'class_id': class_id,
-                    'confidence': confidence,
-                    'x': float(center_x),
-                    'y': float(center_y),
-                    'width': float(width),
-                    'height': float(height),
-                    'x1': float(x1),
-                    'y1': float(y1),
-                    'x2': float(x2),
-                    'y2': float(y2)
-                })
-    
-    return detections
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((image, confidence_threshold, future))
+        return await future
+    
+    async def _collect(self):
+        """Ждет первый запрос, затем добирает батч не дольше max_wait"""
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait
+        
+        while len(batch) < self.batch_size:
+            # Уже ожидающие запросы забираем сразу, без ожидания
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        
+        return batch
+    
+    async def _run(self):
+        while True:
+            batch = await self._collect()
+            images = [image for image, _, _ in batch]
+            confidences = [conf for _, conf, _ in batch]
+            
+            try:
+                # Предсказание блокирующее, выносим его из event loop
+                outputs = await run_in_threadpool(detect_batch, images, confidences)
+                for (_, _, future), output in zip(batch, outputs):
+                    if not future.done():
+                        future.set_result(output)
+            except Exception as e:
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+batcher = InferenceBatcher(model_batch_size, BATCH_MAX_WAIT)
+
+async def process_with_yolo(image: np.ndarray, confidence_threshold: float = 0.25):
+    """Обработка изображения с помощью локальной модели YOLO.
+    
+    Возвращает список детекций и объект Results от Ultralytics (для отрисовки).
+    """
+    
+    if model is None:
+        raise ValueError("Модель не загружена")
+    
+    # Проверяем до постановки в очередь: ошибка в батче затронула бы и чужие запросы
+    if not isinstance(image, np.ndarray) or image.ndim != 3 or image.shape[2] != 3:
+        raise ValueError("Ожидается BGR-изображение numpy.ndarray формы (H, W, 3)")
+    
+    # Большие изображения заранее уменьшаем до IMGSZ в потоке самого запроса (INTER_AREA):
+    # в общий батч не попадают полноразмерные кадры, а боксы потом возвращаем в исходный масштаб
+    height, width = image.shape[:2]
+    scale = IMGSZ / max(height, width)
+    model_image = image
+    if scale < 1:
+        model_size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        model_image = await run_in_threadpool(cv2.resize, image, model_size, interpolation=cv2.INTER_AREA)
+    
+    result = await batcher.submit(model_image, confidence_threshold)
+    return await run_in_threadpool(finish_result, result, image)
 
 def draw_predictions(image, detections):
     """Рисует предсказания на изображении"""
@@ -123,7 +648,7 @@ def draw_predictions(image, detections):
         confidence = detection['confidence']
         
         # Выбираем цвет
-        color = COLORS.get(class_name, COLORS.get(class_id, (255, 255, 255)))
+        color = CLASS_COLORS[class_id]
         
         # Рисуем bounding box
         thickness = 3 if confidence > 0.5 else 2
@@ -133,13 +658,7 @@ def draw_predictions(image, detections):
         label = f"{class_name} {confidence:.0%}"
         
         # Размер текста
-        font = cv2.FONT_HERSHEY_SIMPLEX
-        font_scale = 0.6
-        text_thickness = 2
-        
-        (text_width, text_height), baseline = cv2.getTextSize(
-            label, font, font_scale, text_thickness
-        )
+        (text_width, text_height), baseline = label_size(label)
         
         # Фон для текста (сверху слева от bounding box)
         text_bg_y1 = max(0, y1 - text_height - 10)
@@ -160,28 +679,65 @@ def draw_predictions(image, detections):
             annotated,
             label,
             (x1, y1 - 5),
-            font,
-            font_scale,
+            LABEL_FONT,
+            LABEL_FONT_SCALE,
             (255, 255, 255),
-            text_thickness
+            LABEL_THICKNESS
         )
     
     return annotated
 
-@app.get("/", response_class=HTMLResponse)
-def home():
-    """Главная страница с интерфейсом"""
+def encode_jpeg(image) -> bytes:
+    """Кодирует изображение в JPEG в памяти"""
+    if turbo_jpeg is not None:
+        return turbo_jpeg.encode(image, quality=RESULT_JPEG_QUALITY)
     
-    # Получаем информацию о модели для отображения
-    model_info = ""
-    if model and hasattr(model, 'names'):
-        classes = list(model.names.values())
-        model_info = f"<p>📊 Модель распознает: {', '.join(classes)}</p>"
-    elif model is None:
-        model_info = "<p style='color: orange;'>⚠️ Модель не загружена. Проверьте путь к файлу модели.</p>"
+    ok, buffer = cv2.imencode(
+        ".jpg",
+        image,
+        [cv2.IMWRITE_JPEG_QUALITY, RESULT_JPEG_QUALITY, cv2.IMWRITE_JPEG_OPTIMIZE, 0]
+    )
+    if not ok:
+        raise ValueError("Не удалось закодировать изображение в JPEG")
+    return buffer.tobytes()
+
+def write_jpeg(path: Path, image):
+    """Кодирует изображение в JPEG и записывает на диск"""
+    path.write_bytes(encode_jpeg(image))
+
+async def save_result(image, filename: str) -> Path:
+    """Кодирует результат в JPEG и записывает его в RESULT_DIR, не блокируя event loop"""
+    result_path = RESULT_DIR / filename
+    await run_in_threadpool(write_jpeg, result_path, image)
+    return result_path
+
+def annotate_image(image, detections, result):
+    """Рисует детекции на изображении выбранным способом"""
+    if ANNOTATE_WITH_YOLO:
+        return result.plot(line_width=2, conf=True)
+    return draw_predictions(image, detections)
+
+def warmup_model():
+    """Прогрев до первого запроса: инициализация CUDA, автотюнинг cuDNN, выделение памяти,
+    а также первый вызов разбора результатов, отрисовки и кодирования JPEG"""
+    blank = np.zeros((IMGSZ, IMGSZ, 3), dtype=np.uint8)
+    started = time.time()
+    for _ in range(WARMUP_RUNS):
+        outputs = detect_batch([blank] * model_batch_size, [0.25] * model_batch_size)
     
-    # Используем двойные фигурные скобки для JavaScript (экранируем их)
-    html_content = f"""
+    detections, result = finish_result(outputs[0], blank)
+    encode_jpeg(annotate_image(blank, detections, result))
+    logger.info("🔥 Модель прогрета за %.2fс", time.time() - started)
+
+if model is not None:
+    try:
+        warmup_model()
+    except Exception as e:
+        logger.warning("⚠️ Ошибка прогрева модели: %s", e)
+
+# Шаблон главной страницы (str.format, поэтому фигурные скобки CSS/JavaScript удвоены).
+# Подстановки: {model_info} и {model_path}
+HTML_TEMPLATE = """
     <!DOCTYPE html>
     <html lang="ru">
     <head>
@@ -638,7 +1194,7 @@ def home():
             
             <div class="footer">
                 <p>© 2024 Анализатор газовых факелов | Локальная модель YOLO | Обнаружение объектов в реальном времени</p>
-                <p style="font-size: 0.9rem; margin-top: 10px; opacity: 0.7;">Используется обученная модель: {str(MODEL_PATH)}</p>
+                <p style="font-size: 0.9rem; margin-top: 10px; opacity: 0.7;">Используется обученная модель: {model_path}</p>
             </div>
         </div>
         
@@ -749,7 +1305,7 @@ def home():
                 
                 // Обновляем изображение
                 const resultImage = document.getElementById('resultImage');
-                resultImage.src = `/static/results/${{data.result_image}}?t=${{Date.now()}}`;
+                resultImage.src = `/static/results/${{data.result_image}}`;
                 
                 // Статистика
                 const statsGrid = document.getElementById('statsGrid');
@@ -882,31 +1438,142 @@ def home():
     </body>
     </html>
     """
+
+def render_home_page() -> bytes:
+    """Готовит главную страницу: модель загружается один раз, поэтому и страница одна"""
     
-    return HTMLResponse(content=html_content)
+    # Получаем информацию о модели для отображения
+    model_info = ""
+    if model and MODEL_CLASSES:
+        model_info = f"<p>📊 Модель распознает: {', '.join(MODEL_CLASSES)}</p>"
+    elif model is None:
+        model_info = "<p style='color: orange;'>⚠️ Модель не загружена. Проверьте путь к файлу модели.</p>"
+    
+    return HTML_TEMPLATE.format(model_info=model_info, model_path=MODEL_PATH).encode("utf-8")
+
+HOME_HTML_BYTES = render_home_page()
+HOME_HTML_GZIP = gzip.compress(HOME_HTML_BYTES, compresslevel=9)  # Сжимаем один раз, а не на каждый запрос
+HOME_HTML_MD5 = hashlib.md5(HOME_HTML_BYTES).hexdigest()
+# У сжатой и несжатой версий разные байты, поэтому и ETag у них разный
+HOME_HTML_ETAG = f'"{HOME_HTML_MD5}"'
+HOME_HTML_GZIP_ETAG = f'"{HOME_HTML_MD5}-gzip"'
+HOME_HTML_HEADERS = {
+    "Cache-Control": "public, max-age=300",
+    "Vary": "Accept-Encoding"
+}
+
+def accepts_gzip(accept_encoding: str) -> bool:
+    """Разбирает Accept-Encoding: gzip разрешен, если у него (или у *) q > 0"""
+    qualities = {}
+    for part in accept_encoding.split(","):
+        coding, *params = [item.strip() for item in part.split(";")]
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding.lower()] = quality
+    
+    # Явно указанный gzip важнее звездочки
+    quality = qualities.get("gzip", qualities.get("*", 0.0))
+    return quality > 0
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """Проверяет If-None-Match (список ETag или *) против ETag отдаваемой версии"""
+    if if_none_match.strip() == "*":
+        return True
+    # Для If-None-Match сравнение слабое: префикс W/ не учитываем
+    return any(tag.strip() in (etag, f"W/{etag}") for tag in if_none_match.split(","))
+
+@app.get("/", response_class=HTMLResponse)
+async def home(request: Request):
+    """Главная страница с интерфейсом"""
+    
+    if accepts_gzip(request.headers.get("accept-encoding", "")):
+        content, etag = HOME_HTML_GZIP, HOME_HTML_GZIP_ETAG
+        headers = {**HOME_HTML_HEADERS, "ETag": etag, "Content-Encoding": "gzip"}
+    else:
+        content, etag = HOME_HTML_BYTES, HOME_HTML_ETAG
+        headers = {**HOME_HTML_HEADERS, "ETag": etag}
+    
+    if etag_matches(request.headers.get("if-none-match", ""), etag):
+        headers.pop("Content-Encoding", None)
+        return Response(status_code=304, headers=headers)
+    
+    return HTMLResponse(content=content, headers=headers)
 
 @app.get("/model_info")
 async def get_model_info():
     """Возвращает информацию о загруженной модели"""
     if model is None:
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=503,
             content={"error": "Модель не загружена"}
         )
     
-    classes = []
-    if hasattr(model, 'names'):
-        classes = list(model.names.values())
-    
     return {
         "model_loaded": model is not None,
         "model_path": str(MODEL_PATH),
-        "classes": classes,
-        "num_classes": len(classes) if classes else 0
+        "classes": MODEL_CLASSES,
+        "num_classes": len(MODEL_CLASSES)
     }
 
+# Сигнатуры (первые байты) поддерживаемых форматов изображений
+IMAGE_SIGNATURES = (
+    b"\xff\xd8\xff",          # JPEG
+    b"\x89PNG\r\n\x1a\n",     # PNG
+    b"BM",                    # BMP
+    b"II*\x00", b"MM\x00*",    # TIFF
+)
+
+def is_supported_image(header: bytes) -> bool:
+    """Проверяет по первым байтам, что файл — изображение поддерживаемого формата"""
+    if header.startswith(IMAGE_SIGNATURES):
+        return True
+    return header[:4] == b"RIFF" and header[8:12] == b"WEBP"
+
+async def read_upload(file: UploadFile) -> io.BytesIO:
+    """Читает загруженный файл частями, не больше MAX_UPLOAD_BYTES.
+    
+    Не-изображения отклоняются с 415 по типу содержимого и первым байтам файла,
+    до чтения остального файла и попытки декодирования.
+    """
+    too_large = HTTPException(
+        status_code=413,
+        detail=f"Файл больше {MAX_UPLOAD_BYTES // (1024 * 1024)} МБ"
+    )
+    unsupported = HTTPException(
+        status_code=415,
+        detail="Поддерживаются изображения JPEG, PNG, WebP, BMP и TIFF"
+    )
+    
+    # application/octet-stream пропускаем: формат проверим по первым байтам
+    content_type = file.content_type or ""
+    if content_type and not content_type.startswith("image/") and content_type != "application/octet-stream":
+        raise unsupported
+    
+    # Размер известен заранее — отказываем сразу, не читая файл
+    if file.size is not None and file.size > MAX_UPLOAD_BYTES:
+        raise too_large
+    
+    buffer = io.BytesIO()
+    while chunk := await file.read(UPLOAD_READ_CHUNK):
+        if buffer.tell() == 0 and not is_supported_image(chunk[:16]):
+            raise unsupported
+        if buffer.tell() + len(chunk) > MAX_UPLOAD_BYTES:
+            raise too_large
+        buffer.write(chunk)
+    
+    buffer.seek(0)
+    return buffer
+
 @app.post("/process")
-async def process_image(file: UploadFile = File(...), confidence: float = 0.25):
+async def process_image(background_tasks: BackgroundTasks, file: UploadFile = File(...), confidence: float = 0.25):
     """Обработка изображения с помощью локальной модели YOLO"""
     
     start_time = time.time()
@@ -920,46 +1587,43 @@ async def process_image(file: UploadFile = File(...), confidence: float = 0.25):
         filename = f"{uuid.uuid4()}{file_extension}"
         upload_path = UPLOAD_DIR / filename
         
-        # Сохраняем загруженный файл
-        contents = await file.read()
-        with open(upload_path, "wb") as f:
-            f.write(contents)
-        
-        print(f"📥 Файл сохранен: {upload_path}")
-        
-        # Загружаем изображение для получения размеров
-        image = cv2.imread(str(upload_path))
+        # Декодируем загруженный файл прямо из памяти, без записи и чтения с диска
+        contents = await read_upload(file)
+        image = await run_in_threadpool(decode_image, contents)
         if image is None:
             raise HTTPException(status_code=400, detail="Не удалось загрузить изображение")
         
+        # Оригинал (только для отладки) записываем уже после отправки ответа
+        if SAVE_UPLOADS:
+            background_tasks.add_task(save_upload, upload_path, contents.getbuffer())
+        
         height, width = image.shape[:2]
-        print(f"📏 Размер изображения: {width}x{height}")
+        logger.debug("📏 Размер изображения: %dx%d", width, height)
         
         # Обрабатываем изображение с помощью YOLO
-        detections = process_with_yolo(str(upload_path), confidence)
-        print(f"🔍 Найдено объектов: {len(detections)}")
+        detections, result = await process_with_yolo(image, confidence)
+        logger.debug("🔍 Найдено объектов: %d", len(detections))
         
         # Рисуем предсказания на изображении
-        annotated_image = draw_predictions(image, detections)
+        annotated_image = await run_in_threadpool(annotate_image, image, detections, result)
         
         # Сохраняем результат
-        result_filename = f"result_{filename}"
-        result_path = RESULT_DIR / result_filename
-        cv2.imwrite(str(result_path), annotated_image)
-        print(f"💾 Результат сохранен: {result_path}")
+        result_filename = f"result_{Path(filename).stem}.jpg"
+        result_path = await save_result(annotated_image, result_filename)
+        logger.info("💾 Результат сохранен: %s", result_path)
         
         # Собираем статистику по классам
-        class_stats = {}
-        for detection in detections:
-            class_name = detection['class']
-            class_stats[class_name] = class_stats.get(class_name, 0) + 1
+        class_ids = np.fromiter((d['class_id'] for d in detections), dtype=int, count=len(detections))
+        class_stats = get_class_stats(class_ids)
         
         # Время обработки
         processing_time = time.time() - start_time
         
-        return {
+        # Возвращаем ORJSONResponse напрямую: FastAPI не прогоняет список детекций
+        # через jsonable_encoder
+        return ORJSONResponse({
             "success": True,
-            "original_image": filename,
+            "original_image": filename if SAVE_UPLOADS else None,
             "result_image": result_filename,
             "total_detections": len(detections),
             "class_stats": class_stats,
@@ -971,14 +1635,14 @@ async def process_image(file: UploadFile = File(...), confidence: float = 0.25):
             "model_info": {
                 "name": "YOLO Локальная модель",
                 "path": str(MODEL_PATH),
-                "classes": list(model.names.values()) if hasattr(model, 'names') else []
+                "classes": MODEL_CLASSES
             }
-        }
+        })
         
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"❌ Ошибка обработки: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("❌ Ошибка обработки: %s", e)
         raise HTTPException(status_code=500, detail=f"Ошибка обработки: {str(e)}")
 
 @app.get("/test")
@@ -989,33 +1653,41 @@ async def test_endpoint():
         "model_loaded": model is not None,
         "model_path": str(MODEL_PATH),
         "upload_dir": str(UPLOAD_DIR),
+        "save_uploads": SAVE_UPLOADS,
         "result_dir": str(RESULT_DIR)
     }
 
+TEST_IMAGE_PATH = BASE_DIR / "flaring-gas" / "valid" / "flare_0008_jpg.rf.417f01cce748fb03929cdf7eb156222c.jpg"
+
+@lru_cache(maxsize=1)
+def load_test_image():
+    """Декодированное тестовое изображение (YOLO и отрисовка его не изменяют)"""
+    return decode_image(TEST_IMAGE_PATH)
+
 @app.get("/test_image")
-async def test_image_processing():
+async def test_image_processing(background_tasks: BackgroundTasks):
     """Обработка тестового изображения"""
-    test_image_path = BASE_DIR / "flaring-gas" / "valid" / "flare_0008_jpg.rf.417f01cce748fb03929cdf7eb156222c.jpg"
-    
-    if not test_image_path.exists():
+    if not TEST_IMAGE_PATH.exists():
         return {"error": "Тестовое изображение не найдено"}
     
-    # Копируем в uploads
     filename = f"test_{uuid.uuid4()}.jpg"
-    upload_path = UPLOAD_DIR / filename
-    shutil.copy2(test_image_path, upload_path)
+    
+    # Ссылка на оригинал в uploads нужна только для отладки
+    if SAVE_UPLOADS:
+        background_tasks.add_task(link_upload, TEST_IMAGE_PATH, UPLOAD_DIR / filename)
+    
+    # Тестовое изображение декодируется один раз за время работы сервера
+    image = await run_in_threadpool(load_test_image)
     
     # Обрабатываем
-    detections = process_with_yolo(str(upload_path), 0.25)
+    detections, result = await process_with_yolo(image, 0.25)
     
-    # Загружаем и аннотируем
-    image = cv2.imread(str(upload_path))
-    annotated = draw_predictions(image, detections)
+    # Аннотируем
+    annotated = await run_in_threadpool(annotate_image, image, detections, result)
     
     # Сохраняем результат
     result_filename = f"result_{filename}"
-    result_path = RESULT_DIR / result_filename
-    cv2.imwrite(str(result_path), annotated)
+    await save_result(annotated, result_filename)
     
     return {
         "test_image": filename,
@@ -1037,4 +1709,17 @@ if __name__ == "__main__":
     print(f"🌐 Откройте: http://localhost:8000")
     print("="*60)
     
-    uvicorn.run("main:app", host="127.0.0.1", port=8000, reload=True)
\ No newline at end of file
+    if os.getenv("FLARE_ENV") == "prod":
+        # Без автоперезагрузки; uvloop и httptools (uvloop не работает под Windows).
+        # Каждый воркер загружает свою копию модели в память GPU, поэтому по умолчанию воркер один
+        uvicorn.run(
+            "main:app",
+            host="127.0.0.1",
+            port=8000,
+            workers=int(os.getenv("FLARE_WORKERS", "1")),
+            loop="uvloop" if sys.platform != "win32" else "asyncio",
+            http="httptools",
+            reload=False
+        )
+    else:
+        uvicorn.run("main:app", host="127.0.0.1", port=8000, reload=True)
\ No newline at end of file